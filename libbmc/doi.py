@@ -1,27 +1,164 @@
 """
 This file contains all the DOI-related functions.
 """
+import concurrent.futures
+import hashlib
+import json
+import os
 import re
+import time
+
 import requests
 
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
+from requests.packages.urllib3.util.retry import Retry
+
+# Prefer the RE2 engine (pyre2) when available: it guarantees linear-time
+# matching, which matters when scanning megabytes of text extracted from PDF
+# files. Otherwise, try the third-party regex module, whose engine is faster
+# than the standard one on long subject strings. Fall back on the standard
+# library engine when neither is installed. All three engines expose the
+# same compile/fullmatch/finditer API and behave identically on the DOI
+# pattern.
+#
+# This optional import is deliberately the only native-code hook: with pyre2
+# installed, the whole hot scanning loop already runs inside the C++ RE2
+# matcher, so shipping a dedicated compiled extension would only add a build
+# dependency without making the scan measurably faster.
+try:
+    import re2 as _re
+except ImportError:
+    try:
+        import regex as _re
+    except ImportError:
+        _re = re
 
 from libbmc import __valid_identifiers__
-from libbmc import tools
 
 # Append DOI to the valid identifiers list
 __valid_identifiers__ += ["doi"]
 
+# Folder used to cache results from dx.doi.org / dissem.in on disk, to avoid
+# repeating identical HTTP queries (e.g. when scanning a directory of papers
+# mentioning the same DOIs).
+CACHE_FOLDER = os.path.expanduser("~/.cache/libbmc/doi")
+# Cached results are considered valid for 90 days.
+CACHE_EXPIRATION = 90 * 24 * 3600
+# Cached negative results (DOIs unknown to the upstream API) are retried
+# after one day.
+CACHE_NEGATIVE_EXPIRATION = 24 * 3600
+
+# Maximum number of concurrent HTTP queries in the batched functions
+MAX_CONCURRENT_REQUESTS = 16
+
 # Taken from
 # https://stackoverflow.com/questions/27910/finding-a-doi-in-a-document-or-page/10324802#10324802
-REGEX = re.compile(r"\b(10[.][0-9]{4,}(?:[.][0-9]+)*/(?:(?![\"&\'])\S)+)\b",
-                   re.IGNORECASE)
+REGEX = _re.compile(r"\b(10[.][0-9]{4,}(?:[.][0-9]+)*/[^\s\"&\']+)\b",
+                    _re.IGNORECASE)
 # Base dx.doi.org URL for redirections
 DX_URL = "http://dx.doi.org/{doi}"
+# Prefix equivalent of DX_URL, used internally to build DOI URLs by cheap
+# string concatenation
+_DX_PREFIX = "http://dx.doi.org/"
+# URL prefixes under which DOIs are commonly exposed
+DOI_URL_PREFIXES = ("http://dx.doi.org/", "https://dx.doi.org/",
+                    "http://doi.org/", "https://doi.org/")
 
 # Base DISSEMIN API
 DISSEMIN_API = "http://beta.dissem.in/api/"
 
+# Shared HTTP session, so that the TCP and TLS connections to dx.doi.org and
+# dissem.in are reused across queries instead of being re-established on
+# every call. Transient upstream errors are retried with a small backoff.
+SESSION = requests.Session()
+_ADAPTER = HTTPAdapter(
+    pool_connections=8,
+    pool_maxsize=2 * MAX_CONCURRENT_REQUESTS,
+    max_retries=Retry(total=3, backoff_factor=0.2,
+                      status_forcelist=[429, 500, 502, 503, 504]))
+SESSION.mount("http://", _ADAPTER)
+SESSION.mount("https://", _ADAPTER)
+
+# Literal prefix found in virtually every DOI, used to locate candidate
+# positions cheaply before running the (more expensive) full regex.
+PRESCREEN_LITERAL = "10."
+# Size of the text window scanned by the regex around each candidate position
+PRESCREEN_WINDOW = 512
+
+
+def _cache_file(endpoint, doi):
+    """
+    Get the path of the on-disk cache file for a given query.
+
+    :param endpoint: Name of the query type (e.g. ``"get_bibtex"``).
+    :param doi: The queried canonical DOI.
+    :returns: The path of the associated cache file.
+    """
+    query_hash = hashlib.sha1(
+        ("%s:%s" % (endpoint, doi)).encode("utf-8")).hexdigest()
+    return os.path.join(CACHE_FOLDER, "%s.json" % (query_hash,))
+
+
+def _cache_get_entry(endpoint, doi):
+    """
+    Fetch a previously cached entry for a given query, regardless of its \
+            expiration.
+
+    :param endpoint: Name of the query type (e.g. ``"get_bibtex"``).
+    :param doi: The queried canonical DOI.
+    :returns: The cached entry, a dict with ``"time"`` and ``"value"`` keys \
+            (plus optional HTTP validators), or ``None`` if the query is \
+            not cached.
+    """
+    try:
+        with open(_cache_file(endpoint, doi), "r") as fh:
+            entry = json.load(fh)
+        if "time" in entry and "value" in entry:
+            return entry
+    except (OSError, ValueError):
+        # Unreadable or corrupted cache entries are treated as cache misses
+        pass
+    return None
+
+
+def _cache_get(endpoint, doi):
+    """
+    Fetch a previously cached result for a given query.
+
+    :param endpoint: Name of the query type (e.g. ``"get_bibtex"``).
+    :param doi: The queried canonical DOI.
+    :returns: The cached result, or ``None`` if the query is not cached or \
+            the cached result has expired.
+    """
+    entry = _cache_get_entry(endpoint, doi)
+    if entry is not None and time.time() - entry["time"] < CACHE_EXPIRATION:
+        return entry["value"]
+    return None
+
+
+def _cache_set(endpoint, doi, value, validators=None):
+    """
+    Store the result of a given query in the on-disk cache.
+
+    :param endpoint: Name of the query type (e.g. ``"get_bibtex"``).
+    :param doi: The queried canonical DOI.
+    :param value: The (JSON-serializable) result to cache.
+    :param validators: An optional dict of HTTP validators (ETag, \
+            Last-Modified) to store along with the result, for conditional \
+            refreshes.
+    """
+    entry = {"time": time.time(), "value": value}
+    if validators is not None:
+        entry.update(validators)
+    try:
+        os.makedirs(CACHE_FOLDER, exist_ok=True)
+        with open(_cache_file(endpoint, doi), "w") as fh:
+            json.dump(entry, fh)
+    except OSError:
+        # Caching is best effort only, never let it break the query itself
+        pass
+
 
 def is_valid(doi):
     """
@@ -54,8 +191,7 @@ def is_valid(doi):
     >>> is_valid('<geo coords="10.4515260,51.1656910"></geo>')
     False
     """
-    match = REGEX.match(doi)
-    return (match is not None) and (match.group(0) == doi)
+    return REGEX.fullmatch(doi) is not None
 
 
 def extract_from_text(text):
@@ -68,7 +204,28 @@ def extract_from_text(text):
     >>> sorted(extract_from_text('10.1209/0295-5075/111/40005 10.1016.12.31/nature.S0735-1097(98)2000/12/31/34:7-7 10.1002/(SICI)1522-2594(199911)42:5<952::AID-MRM16>3.0.CO;2-S 10.1007/978-3-642-28108-2_19 10.1007.10/978-3-642-28108-2_19 10.1016/S0735-1097(98)00347-7 10.1579/0044-7447(2006)35\[89:RDUICP\]2.0.CO;2 <geo coords="10.4515260,51.1656910"></geo>'))
     ['10.1002/(SICI)1522-2594(199911)42:5<952::AID-MRM16>3.0.CO;2-S', '10.1007.10/978-3-642-28108-2_19', '10.1007/978-3-642-28108-2_19', '10.1016.12.31/nature.S0735-1097(98)2000/12/31/34:7-7', '10.1016/S0735-1097(98)00347-7', '10.1209/0295-5075/111/40005', '10.1579/0044-7447(2006)35\\\\[89:RDUICP\\\\]2.0.CO;2']
     """
-    return tools.remove_duplicates(REGEX.findall(text))
+    # Matches are deduplicated on the fly, in first-appearance order, by
+    # using them as dict keys
+    dois = {}
+    # Offset up to which the text is already covered by a previous match,
+    # used to avoid reporting DOIs nested inside an already found one
+    covered_until = 0
+    position = text.find(PRESCREEN_LITERAL)
+    while position != -1:
+        if position >= covered_until:
+            # Only run the regex on a small window around the candidate
+            # position. The window starts one character early, so that the
+            # leading word boundary is evaluated correctly, and is extended
+            # up to the next whitespace so that no match is truncated.
+            window_start = max(0, position - 1)
+            window_end = position + PRESCREEN_WINDOW
+            while window_end < len(text) and not text[window_end].isspace():
+                window_end += 1
+            for match in REGEX.finditer(text[window_start:window_end]):
+                dois.setdefault(match.group(0), None)
+                covered_until = window_start + match.end()
+        position = text.find(PRESCREEN_LITERAL, position + 1)
+    return list(dois)
 
 
 def to_url(dois):
@@ -85,9 +242,28 @@ def to_url(dois):
     'http://dx.doi.org/10.1209/0295-5075/111/40005'
     """
     if isinstance(dois, list):
-        return [DX_URL.format(doi=doi) for doi in dois]
+        return [_DX_PREFIX + doi for doi in dois]
     else:
-        return DX_URL.format(doi=dois)
+        return _DX_PREFIX + dois
+
+
+def _to_canonical_single(url):
+    """
+    Convert a single DOI URL to a canonical DOI.
+
+    :param url: A DOI URL.
+    :returns: The canonical DOI, or ``None`` if an error occurred.
+    """
+    # Fast path: for a well-formed DOI URL, stripping the prefix is enough
+    if url.startswith(DOI_URL_PREFIXES):
+        doi = url.split("doi.org/", 1)[1]
+        if is_valid(doi):
+            return doi
+    # Fall back on a full text extraction for anything else
+    found_dois = extract_from_text(url)
+    if found_dois:
+        return found_dois[0]
+    return None
 
 
 def to_canonical(urls):
@@ -110,7 +286,88 @@ def to_canonical(urls):
     >>> to_canonical(['aaaa']) is None
     True
     """
-    return tools.map_or_apply(extract_from_text, urls)
+    if isinstance(urls, list):
+        dois = [_to_canonical_single(url) for url in urls]
+        if None in dois:
+            return None
+        return dois
+    return _to_canonical_single(urls)
+
+
+# In-process memoization of successful dissem.in fetches. Only successful
+# documents are stored here: memoizing failures would pin a transient
+# network error to its DOI for the whole process, and memoizing negative
+# results would override their shorter on-disk expiration.
+_DISSEMIN_MEMO = {}
+
+
+def _fetch_dissemin(doi):
+    """
+    Fetch and parse the dissem.in API document for a given DOI.
+
+    Both :func:`get_oa_version` and :func:`get_oa_policy` read from the same
+    API endpoint, so the document is fetched only once, memoized in-process
+    (successful lookups only) and cached on disk. Negative results (DOIs
+    unknown to the API) are cached too, with a shorter expiration; expired
+    entries are refreshed with a conditional GET so an unchanged document
+    costs no body transfer nor JSON parsing.
+
+    :param doi: A canonical DOI.
+    :returns: The parsed JSON document, or ``None`` if the query failed or \
+            the API reported an error.
+    """
+    memoized = _DISSEMIN_MEMO.get(doi, None)
+    if memoized is not None:
+        return memoized
+    entry = _cache_get_entry("dissemin", doi)
+    if entry is not None:
+        if entry["value"] is None:
+            expiration = CACHE_NEGATIVE_EXPIRATION
+        else:
+            expiration = CACHE_EXPIRATION
+        if time.time() - entry["time"] < expiration:
+            if entry["value"] is not None:
+                _DISSEMIN_MEMO[doi] = entry["value"]
+            return entry["value"]
+    # Expired or missing entry: query the API, asking it to skip the body if
+    # the document did not change since it was cached
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["if-none-match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["if-modified-since"] = entry["last_modified"]
+    try:
+        request = SESSION.get("%s%s" % (DISSEMIN_API, doi), headers=headers)
+        if request.status_code == 304:
+            # Not modified: extend the cached entry without parsing a body
+            _cache_set("dissemin", doi, entry["value"],
+                       validators={"etag": entry.get("etag"),
+                                   "last_modified":
+                                       entry.get("last_modified")})
+            if entry["value"] is not None:
+                _DISSEMIN_MEMO[doi] = entry["value"]
+            return entry["value"]
+        result = None
+        if request.status_code == 200:
+            try:
+                result = request.json()
+            except ValueError:
+                result = None
+            if result is not None and result.get("status") != "ok":
+                result = None
+        # Cache positive and negative results alike; negative ones (missing
+        # DOIs, API errors) simply expire sooner
+        _cache_set("dissemin", doi, result,
+                   validators={"etag": request.headers.get("etag"),
+                               "last_modified":
+                                   request.headers.get("last-modified")})
+        if result is not None:
+            _DISSEMIN_MEMO[doi] = result
+        return result
+    except RequestException:
+        # Network failures are transient, do not cache them
+        return None
 
 
 def get_oa_version(doi):
@@ -127,13 +384,10 @@ def get_oa_version(doi):
     >>> get_oa_version('10.1209/0295-5075/111/40005')
     'http://arxiv.org/abs/1506.06690'
     """
+    result = _fetch_dissemin(doi)
     try:
-        request = requests.get("%s%s" % (DISSEMIN_API, doi))
-        request.raise_for_status()
-        result = request.json()
-        assert result["status"] == "ok"
         return result["paper"]["pdf_url"]
-    except (AssertionError, ValueError, KeyError, RequestException):
+    except (TypeError, KeyError):
         return None
 
 
@@ -155,16 +409,12 @@ def get_oa_policy(doi):
     >>> get_oa_policy('10.1215/9780822387268') is None
     True
     """
+    result = _fetch_dissemin(doi)
     try:
-        request = requests.get("%s%s" % (DISSEMIN_API, doi))
-        request.raise_for_status()
-        result = request.json()
-        assert result["status"] == "ok"
         return ([i
                  for i in result["paper"]["publications"]
                  if i["doi"] == doi][0])["policy"]
-    except (AssertionError, ValueError,
-            KeyError, RequestException, IndexError):
+    except (TypeError, KeyError, IndexError):
         return None
 
 
@@ -178,9 +428,15 @@ def get_linked_version(doi):
     >>> get_linked_version('10.1209/0295-5075/111/40005')
     'http://stacks.iop.org/0295-5075/111/i=4/a=40005?key=crossref.9ad851948a976ecdf216d4929b0b6f01'
     """
+    cached = _cache_get("get_linked_version", doi)
+    if cached is not None:
+        return cached
     try:
-        request = requests.head(to_url(doi))
-        return request.headers.get("location")
+        request = SESSION.head(to_url(doi))
+        linked_version = request.headers.get("location")
+        if linked_version is not None:
+            _cache_set("get_linked_version", doi, linked_version)
+        return linked_version
     except RequestException:
         return None
 
@@ -199,11 +455,83 @@ def get_bibtex(doi):
     >>> get_bibtex('10.1209/0295-5075/111/40005')
     '@article{Verney_2015,\\n\\tdoi = {10.1209/0295-5075/111/40005},\\n\\turl = {http://dx.doi.org/10.1209/0295-5075/111/40005},\\n\\tyear = 2015,\\n\\tmonth = {aug},\\n\\tpublisher = {{IOP} Publishing},\\n\\tvolume = {111},\\n\\tnumber = {4},\\n\\tpages = {40005},\\n\\tauthor = {Lucas Verney and Lev Pitaevskii and Sandro Stringari},\\n\\ttitle = {Hybridization of first and second sound in a weakly interacting Bose gas},\\n\\tjournal = {{EPL}}\\n}'
     """
+    cached = _cache_get("get_bibtex", doi)
+    if cached is not None:
+        return cached
     try:
-        request = requests.get(to_url(doi),
-                               headers={"accept": "application/x-bibtex"})
+        request = SESSION.get(to_url(doi),
+                              headers={"accept": "application/x-bibtex"})
         request.raise_for_status()
-        assert request.headers.get("content-type") == "application/x-bibtex"
+        if request.headers.get("content-type") != "application/x-bibtex":
+            return None
+        _cache_set("get_bibtex", doi, request.text)
         return request.text
-    except (RequestException, AssertionError):
+    except RequestException:
         return None
+
+
+def _map_concurrently(function, dois):
+    """
+    Run a single-DOI function on a list of DOIs, using concurrent HTTP \
+            queries.
+
+    :param function: The single-DOI function to map.
+    :param dois: A list of canonical DOIs.
+    :returns: The list of results, in the same order as the input DOIs.
+    """
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_REQUESTS) as executor:
+        return list(executor.map(function, dois))
+
+
+def get_oa_version_many(dois):
+    """
+    Get OA versions for a list of DOIs, fetching them concurrently. Cached \
+            DOIs do not hit the network at all.
+
+    .. note::
+
+        Uses beta.dissem.in API.
+
+    :param dois: A list of canonical DOIs.
+    :returns: The list of URLs of the OA versions (or ``None`` values), in \
+            the same order as the input DOIs.
+
+    >>> get_oa_version_many(['10.1209/0295-5075/111/40005'])
+    ['http://arxiv.org/abs/1506.06690']
+    """
+    return _map_concurrently(get_oa_version, dois)
+
+
+def get_oa_policy_many(dois):
+    """
+    Get OA policies for a list of DOIs, fetching them concurrently. Cached \
+            DOIs do not hit the network at all.
+
+    .. note::
+
+        Uses beta.dissem.in API.
+
+    :param dois: A list of canonical DOIs.
+    :returns: The list of OA policies (or ``None`` values), in the same \
+            order as the input DOIs.
+
+    >>> get_oa_policy_many(['10.1215/9780822387268'])
+    [None]
+    """
+    return _map_concurrently(get_oa_policy, dois)
+
+
+def get_bibtex_many(dois):
+    """
+    Get BibTeX entries for a list of DOIs, fetching them concurrently. \
+            Cached DOIs do not hit the network at all.
+
+    :param dois: A list of canonical DOIs.
+    :returns: The list of BibTeX strings (or ``None`` values), in the same \
+            order as the input DOIs.
+
+    >>> get_bibtex_many(['10.1209/0295-5075/111/40005'])  # doctest: +ELLIPSIS
+    ['@article{Verney_2015,...}']
+    """
+    return _map_concurrently(get_bibtex, dois)
@@ -6,15 +6,113 @@ Needs pdftotext and/or djvutxt installed on the machine.
 
 TODO: Unittests
 """
-import importlib
+import io
+import re
 import subprocess
-import sys
 
-from libbmc import __valid_identifiers__
+# Importing the identifier modules appends them to __valid_identifiers__
+from libbmc import doi
+from libbmc import isbn
+from libbmc.repositories import arxiv
+
+# Modules associated to the valid identifier types, resolved once at import
+# time instead of being looked up in sys.modules on every scanned chunk
+_IDENTIFIER_MODULES = [
+    ("doi", doi),
+    ("isbn", isbn),
+    ("repositories.arxiv", arxiv),
+]
+# Pre-bound hot entry points of the identifier modules
+_EXTRACTORS = [(name, module.extract_from_text)
+               for name, module in _IDENTIFIER_MODULES]
+_BIBTEX_FETCHERS = {name: module.get_bibtex
+                    for name, module in _IDENTIFIER_MODULES}
+
+# Loose prescreening patterns for identifier types whose module does not
+# expose a ``REGEX`` attribute. A pattern MUST match a superset of what the
+# module's ``extract_from_text`` would find, as the prescreening pass skips
+# the extractors whose pattern did not match anywhere in the text. No such
+# pattern is known for ISBNs — isbnlib tolerates arbitrary separator runs
+# (e.g. "0-13--609181-4") — so the isbn extractor is never skipped and
+# always runs.
+PRESCREEN_PATTERNS = {}
+
+# Size of the first block read from the text converter's output: most
+# journal papers carry their identifier on the first page, so a small first
+# scan lets the conversion be stopped after a few KiB in the common case
+FIRST_BLOCK_SIZE = 8 * 1024
+# Size of the subsequent blocks read from the text converter's output
+READ_BLOCK_SIZE = 64 * 1024
+# Overlap kept between two successive scans, so that identifiers spanning a
+# scan boundary are not missed. Apart from this overlap, text is never
+# scanned twice: each pass of find_identifiers only covers the newly
+# converted block, keeping the total regex work linear in the document size.
+SCAN_OVERLAP = 256
+
+
+def _build_prescreen_regex():
+    """
+    Compile a single regex combining the patterns of all the valid \
+            identifier types, so that a text chunk is scanned once instead \
+            of once per type.
+
+    :returns: A tuple of the compiled regex (``None`` if no identifier type \
+            can be prescreened) and a dict mapping the regex group names to \
+            identifier types.
+    """
+    patterns = []
+    groups = {}
+    for position, (identifier, module) in enumerate(_IDENTIFIER_MODULES):
+        pattern = PRESCREEN_PATTERNS.get(identifier, None)
+        if pattern is None:
+            module_regex = getattr(module, "REGEX", None)
+            if module_regex is not None:
+                pattern = module_regex.pattern
+        if pattern is None:
+            # No known pattern for this type: it cannot be prescreened
+            # and its extractor will always run
+            continue
+        # Identifier types may contain dots, use positional group names
+        group = "i%d" % (position,)
+        groups[group] = identifier
+        patterns.append("(?P<%s>%s)" % (group, pattern))
+    if patterns:
+        return (re.compile("|".join(patterns), re.IGNORECASE), groups)
+    return (None, groups)
+
+
+PRESCREEN_REGEX, PRESCREEN_GROUPS = _build_prescreen_regex()
+
+
+def _extract_first_identifier(text):
+    """
+    Run the extractors of all the valid identifier types on a text chunk.
 
-# Import all the modules associated to __valid_identifiers__
-for valid_identifier in __valid_identifiers__:
-    importlib.import_module("libbmc.%s" % (valid_identifier,))
+    The text is first scanned in a single pass with the combined regex of \
+            all the identifier patterns, and only the extractors whose \
+            pattern actually matched somewhere in the text are run.
+
+    :param text: The text to scan.
+    :returns: A tuple (type, identifier), or ``None`` if no identifier was \
+            found.
+    """
+    prescreened = set(PRESCREEN_GROUPS.values())
+    candidates = set()
+    if PRESCREEN_REGEX is not None:
+        for match in PRESCREEN_REGEX.finditer(text):
+            candidates.add(PRESCREEN_GROUPS[match.lastgroup])
+            if candidates == prescreened:
+                break
+    # Loop over all the valid identifier types
+    for identifier, extract_from_text in _EXTRACTORS:
+        # Skip the types whose pattern did not match in the prescreening pass
+        if identifier in prescreened and identifier not in candidates:
+            continue
+        found_id = extract_from_text(text)
+        if found_id:
+            # found_id is a list of found IDs
+            return (identifier, found_id[0])
+    return None
 
 
 def find_identifiers(src):
@@ -38,34 +136,68 @@ def find_identifiers(src):
     :returns: a tuple (type, identifier) or ``(None, None)`` if not found or \
             an error occurred.
     """
+    # Converter warnings are discarded: an undrained stderr pipe could fill
+    # up and deadlock the converter on noisy documents.
     if src.endswith(".pdf"):
         totext = subprocess.Popen(["pdftotext", src, "-"],
                                   stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE,
-                                  bufsize=1)
+                                  stderr=subprocess.DEVNULL,
+                                  bufsize=READ_BLOCK_SIZE)
     elif src.endswith(".djvu"):
         totext = subprocess.Popen(["djvutxt", src],
                                   stdout=subprocess.PIPE,
-                                  stderr=subprocess.PIPE,
-                                  bufsize=1)
+                                  stderr=subprocess.DEVNULL,
+                                  bufsize=READ_BLOCK_SIZE)
     else:
         return (None, None)
 
-    while totext.poll() is None:
-        extract_full = ' '.join([i.decode("utf-8").strip()
-                                 for i in totext.stdout.readlines()])
-        # Loop over all the valid identifier types
-        for identifier in __valid_identifiers__:
-            # Dynamically call the ``extract_from_text`` method for the
-            # associated module.
-            module = sys.modules.get("libbmc.%s" % (identifier,), None)
-            if module is None:
-                continue
-            found_id = getattr(module, "extract_from_text")(extract_full)
-            if found_id:
-                totext.terminate()
-                # found_id is a list of found IDs
-                return (identifier, found_id[0])
+    # Stream the converted text and scan it incrementally, instead of
+    # accumulating the whole document: each scan only covers the newly
+    # extracted block (plus a small overlap with the previous scan), and the
+    # conversion is stopped as soon as an identifier is found. The text
+    # wrapper decodes the stream on the fly, taking care of multi-byte
+    # characters split across two blocks.
+    text_stream = io.TextIOWrapper(totext.stdout, encoding="utf-8",
+                                   errors="replace")
+    # Raw text carried over from the previous block: the read boundary can
+    # fall in the middle of an identifier, so the trailing (possibly
+    # partial) token is held back, never scanned on its own, and glued to
+    # the next block without any separator.
+    carry = ""
+    # The first scan is run on a small prefix of the document, so that the
+    # conversion can be stopped almost immediately in the common case of an
+    # identifier on the first page. Note that this biases the result toward
+    # the document's own identifier rather than the ones in its references.
+    block_size = FIRST_BLOCK_SIZE
+    while True:
+        block = text_stream.read(block_size)
+        if not block:
+            break
+        block_size = READ_BLOCK_SIZE
+        text = carry + block
+        # Only scan up to the last whitespace: the trailing token may
+        # continue in the next block
+        cut = len(text)
+        if not text[-1].isspace():
+            while cut > 0 and not text[cut - 1].isspace():
+                cut -= 1
+        carry = text[max(0, cut - SCAN_OVERLAP):]
+        # Collapse newlines and repeated whitespaces, the identifier
+        # extractors expect space-separated text
+        chunk = ' '.join(text[:cut].split())
+        if not chunk:
+            continue
+        found_identifier = _extract_first_identifier(chunk)
+        if found_identifier is not None:
+            totext.terminate()
+            return found_identifier
+    totext.wait()
+    # Final scan, covering the held back tail of the last block
+    chunk = ' '.join(carry.split())
+    if chunk:
+        found_identifier = _extract_first_identifier(chunk)
+        if found_identifier is not None:
+            return found_identifier
     return (None, None)
 
 
@@ -82,11 +214,8 @@ def get_bibtex(identifier):
     # TODO: Should return a BiBTeX object?
     """
     identifier_type, identifier_id = identifier
-    if identifier_type not in __valid_identifiers__:
-        return None
-
-    # Dynamically call the ``get_bibtex`` method from the associated module.
-    module = sys.modules.get("libbmc.%s" % (identifier_type,), None)
-    if module is None:
+    # Call the pre-bound ``get_bibtex`` method from the associated module.
+    fetcher = _BIBTEX_FETCHERS.get(identifier_type, None)
+    if fetcher is None:
         return None
-    return getattr(module, "get_bibtex")(identifier_id)
+    return fetcher(identifier_id)
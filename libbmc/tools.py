@@ -70,7 +70,8 @@ def clean_whitespaces(text):
 
 def remove_duplicates(some_list):
     """
-    Remove the duplicates from a list.
+    Remove the duplicates from a list, keeping the order of first \
+    appearance.
 
     :param some_list: List to remove duplicates from.
     :returns: A list without duplicates.
@@ -81,7 +82,7 @@ def remove_duplicates(some_list):
     >>> remove_duplicates([1, 2, 1, 2])
     [1, 2]
     """
-    return list(set(some_list))
+    return list(dict.fromkeys(some_list))
 
 
 def batch(iterable, size):